@@ -0,0 +1 @@
+When a NickServ ``password`` is configured, the IRC bot now joins its channels once NickServ has identified it, so that channel access lists apply, or after 3 seconds if no confirmation arrives.
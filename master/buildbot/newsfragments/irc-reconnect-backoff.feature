@@ -0,0 +1 @@
+IRC bot now backs off exponentially when it repeatedly fails to reconnect to the server.
@@ -13,10 +13,13 @@
 #
 # Copyright Buildbot Team Members
 
+import functools
+import random
+from collections import OrderedDict
+
 from twisted.application import internet
 from twisted.internet import defer
 from twisted.internet import reactor
-from twisted.internet import task
 from twisted.python import log
 from twisted.words.protocols import irc
 
@@ -66,6 +69,24 @@ _irc_colors = (
     'LIGHT_GRAY'
 )
 
+# ClientContextFactory keeps no state: it creates a new SSL context each time
+# one is requested, so a single instance is shared by all IRC services
+_ssl_context_factory = ssl.ClientContextFactory() if ssl.has_ssl else None
+
+
+# IRC nicknames and channel names are case insensitive, using the casemapping
+# from RFC 1459 in which {}|~ are the lower case equivalents of []\^.  Only
+# ASCII characters are folded.
+_irc_casemap = str.maketrans("ABCDEFGHIJKLMNOPQRSTUVWXYZ[]\\^",
+                             "abcdefghijklmnopqrstuvwxyz{}|~")
+
+
+# translate() is several times slower than a cache lookup, and the same few
+# nicknames and channels are folded for every incoming message
+@functools.lru_cache(maxsize=1024)
+def _irc_lower(s):
+    return s.translate(_irc_casemap)
+
 
 class IRCChannel(Channel):
 
@@ -203,30 +224,68 @@ class IrcStatusBot(StatusBot, irc.IRCClient):
     contactClass = IRCContact
     channelClass = IRCChannel
 
+    # maximum number of hostmask -> nickname entries to remember
+    nick_cache_size = 256
+    # how long to wait for NickServ to identify us before joining channels
+    identify_timeout = 3.0
+    # maximum length of the channels and keys lists of a single JOIN command,
+    # well below the 512 bytes limit of an IRC line
+    max_join_length = 400
+
     def __init__(self, nickname, password, join_channels, pm_to_nicks,
                  noticeOnChannel, *args, useColors=False, **kwargs):
         super().__init__(*args, **kwargs)
-        self.nickname = nickname
+        self._set_nickname(nickname)
         self.join_channels = join_channels
         self.pm_to_nicks = pm_to_nicks
         self.password = password
-        self.hasQuit = 0
         self.noticeOnChannel = noticeOnChannel
         self.useColors = useColors
-        self._keepAliveCall = task.LoopingCall(
-            lambda: self.ping(self.nickname))
+        self._keepAliveCall = None
+        self._joinCall = None
         self._channel_names = {}
+        self._nick_cache = OrderedDict()
+
+    def _set_nickname(self, nickname):
+        self.nickname = nickname
+        # prefixes used to address the bot in a channel, e.g. "nick: hello"
+        self._addr_prefixes = (nickname + ":", nickname + ",")
+        self._addr_prefix_len = len(nickname) + 1
+
+    def nickChanged(self, nick):
+        self._set_nickname(nick)
+
+    def _nick_of(self, user):
+        # user is 'nick!~user@hostname'; the same user usually sends several
+        # messages in a row, so remember the last few parsed hostmasks
+        nick = self._nick_cache.get(user)
+        if nick is None:
+            nick = user.partition('!')[0]
+            self._nick_cache[user] = nick
+            if len(self._nick_cache) > self.nick_cache_size:
+                self._nick_cache.popitem(last=False)
+        return nick
 
     def connectionMade(self):
         super().connectionMade()
-        self._keepAliveCall.start(60)
+        self._keepAliveCall = reactor.callLater(60, self._keepAlive)
 
     def connectionLost(self, reason):
-        if self._keepAliveCall.running:
-            self._keepAliveCall.stop()
+        if self._keepAliveCall is not None and self._keepAliveCall.active():
+            self._keepAliveCall.cancel()
+        self._keepAliveCall = None
+        if self._joinCall is not None and self._joinCall.active():
+            self._joinCall.cancel()
+        self._joinCall = None
         super().connectionLost(reason)
 
+    def _keepAlive(self):
+        self.ping(self.nickname)
+        self._keepAliveCall = reactor.callLater(60, self._keepAlive)
+
     # The following methods are called when we write something.
+    # Messages are kept as str: IRCClient splits them into lines that fit the
+    # protocol limits and encodes each line itself when it is written.
     def groupSend(self, channel, message):
         if self.noticeOnChannel:
             self.notice(channel, message)
@@ -238,15 +297,15 @@ class IrcStatusBot(StatusBot, irc.IRCClient):
 
     def getContact(self, user, channel=None):
         # nicknames and channel names are case insensitive
-        user = user.lower()
+        user = _irc_lower(user)
         if channel is None:
             channel = user
-        channel = channel.lower()
+        channel = _irc_lower(channel)
         return super().getContact(user, channel)
 
     # the following irc.IRCClient methods are called when we have input
     def privmsg(self, user, channel, message):
-        user = user.split('!', 1)[0]  # rest is ~user@hostname
+        user = self._nick_of(user)
         # channel is '#twisted' or 'buildbot' (for private messages)
         if channel == self.nickname:
             # private message
@@ -256,36 +315,92 @@ class IrcStatusBot(StatusBot, irc.IRCClient):
         # else it's a broadcast message, maybe for us, maybe not. 'channel'
         # is '#twisted' or the like.
         contact = self.getContact(user=user, channel=channel)
-        if message.startswith("%s:" % self.nickname) or message.startswith("%s," % self.nickname):
-            message = message[len("%s:" % self.nickname):]
+        if message.startswith(self._addr_prefixes):
+            message = message[self._addr_prefix_len:]
             d = contact.handleMessage(message)
             return d
 
     def action(self, user, channel, data):
-        user = user.split('!', 1)[0]  # rest is ~user@hostname
+        user = self._nick_of(user)
         # somebody did an action (/me actions) in the broadcast channel
         contact = self.getContact(user=user, channel=channel)
         if self.nickname in data:
             contact.handleAction(data)
 
     def signedOn(self):
+        # irc_RPL_WELCOME sets the nickname the server actually accepted
+        self._set_nickname(self.nickname)
+        if self.factory is not None:
+            self.factory.resetDelay()
         if self.password:
             self.msg("Nickserv", "IDENTIFY " + self.password)
-        for c in self.join_channels:
-            if isinstance(c, dict):
-                channel = c.get('channel', None)
-                password = c.get('password', None)
-            else:
-                channel = c
-                password = None
-            self.join(channel=channel, key=password)
+            # join the channels once we are identified, so that access lists
+            # apply, but do not wait on a slow NickServ for more than
+            # identify_timeout
+            self._joinCall = reactor.callLater(self.identify_timeout,
+                                               self._joinChannels)
+        else:
+            self._joinChannels()
         for c in self.pm_to_nicks:
             contact = self.getContact(c)
             contact.channel.add_notification_events(self.notify_events)
         self.loadState()
 
+    def _joinChannels(self):
+        if self._joinCall is not None and self._joinCall.active():
+            self._joinCall.cancel()
+        self._joinCall = None
+        # join as many channels as possible with each JOIN command.  Keys are
+        # matched to channels by position, so channels with a key come first.
+        channels = sorted(self.join_channels, key=lambda c: not c[1])
+        names, keys, length = [], [], 0
+        for channel, password in channels:
+            if ',' in channel or (password and ',' in password):
+                # would be split when sent as part of a list
+                self.join(channel=channel, key=password)
+                continue
+            if channel[0] not in irc.CHANNEL_PREFIXES:
+                channel = "#" + channel
+            size = len(channel.encode('utf-8')) + 1
+            if password:
+                size += len(password.encode('utf-8')) + 1
+            if names and length + size > self.max_join_length:
+                self._sendJoin(names, keys)
+                names, keys, length = [], [], 0
+            names.append(channel)
+            if password:
+                keys.append(password)
+            length += size
+        if names:
+            self._sendJoin(names, keys)
+
+    def _sendJoin(self, channels, keys):
+        if keys:
+            self.sendLine("JOIN {} {}".format(",".join(channels), ",".join(keys)))
+        else:
+            self.sendLine("JOIN {}".format(",".join(channels)))
+
+    def irc_900(self, prefix, params):
+        # RPL_LOGGEDIN: <me> <nick!user@host> <account> :You are now logged in
+        if self._joinCall is not None:
+            self._joinChannels()
+
+    def noticed(self, user, channel, message):
+        # Servers without RPL_LOGGEDIN: NickServ answers IDENTIFY with a
+        # notice, whose wording varies, so ask the server whether we are
+        # logged in now.
+        if self._joinCall is not None and _irc_lower(self._nick_of(user)) == 'nickserv':
+            self.sendLine("WHOIS " + self.nickname)
+
+    def irc_330(self, prefix, params):
+        # RPL_WHOISACCOUNT: <me> <nick> <account> :is logged in as
+        if self._joinCall is None:
+            return
+        if _irc_lower(params[1]) == _irc_lower(self.nickname):
+            self._joinChannels()
+
     def getNames(self, channel):
-        channel = channel.lower()
+        channel = _irc_lower(channel)
         d = defer.Deferred()
         callbacks = self._channel_names.setdefault(channel, ([], []))[0]
         callbacks.append(d)
@@ -293,7 +408,7 @@ class IrcStatusBot(StatusBot, irc.IRCClient):
         return d
 
     def irc_RPL_NAMREPLY(self, prefix, params):
-        channel = params[2].lower()
+        channel = _irc_lower(params[2])
         if channel not in self._channel_names:
             return
         nicks = params[3].split(' ')
@@ -301,7 +416,7 @@ class IrcStatusBot(StatusBot, irc.IRCClient):
         nicklist += nicks
 
     def irc_RPL_ENDOFNAMES(self, prefix, params):
-        channel = params[1].lower()
+        channel = _irc_lower(params[1])
         try:
             callbacks, namelist = self._channel_names.pop(channel)
         except KeyError:
@@ -315,24 +430,24 @@ class IrcStatusBot(StatusBot, irc.IRCClient):
         return [n[1:] for n in names if n[0] in '@&~%']
 
     def joined(self, channel):
-        self.log("Joined %s" % (channel,))
+        self.log(format="Joined %(channel)s", channel=channel)
         # trigger contact constructor, which in turn subscribes to notify events
-        channel = self.getChannel(channel=channel)
+        channel = self.getChannel(channel=_irc_lower(channel))
         channel.add_notification_events(self.notify_events)
 
     def left(self, channel):
-        self.log("Left %s" % (channel,))
+        self.log(format="Left %(channel)s", channel=channel)
 
     def kickedFrom(self, channel, kicker, message):
-        self.log("I have been kicked from %s by %s: %s" % (channel,
-                                                           kicker,
-                                                           message))
+        # 'message' is a reserved key of log events
+        self.log(format="I have been kicked from %(channel)s by %(kicker)s: %(reason)s",
+                 channel=channel, kicker=kicker, reason=message)
 
     def userLeft(self, user, channel):
         if user:
-            user = user.lower()
+            user = _irc_lower(user)
         if channel:
-            channel = channel.lower()
+            channel = _irc_lower(channel)
         if (channel, user) in self.contacts:
             del self.contacts[(channel, user)]
 
@@ -341,7 +456,7 @@ class IrcStatusBot(StatusBot, irc.IRCClient):
 
     def userQuit(self, user, quitMessage=None):
         if user:
-            user = user.lower()
+            user = _irc_lower(user)
         for c, u in list(self.contacts):
             if u == user:
                 del self.contacts[(c, u)]
@@ -383,6 +498,11 @@ class IrcStatusFactory(ThrottledClientFactory):
 
     shuttingDown = False
     p = None
+    lostAttempts = 0
+    failedAttempts = 0
+    _reconnectCall = None
+    # upper bound of the reconnection delay, before jitter is applied
+    maxDelay = 300
 
     def __init__(self, nickname, password, join_channels, pm_to_nicks, authz, tags, notify_events,
                  noticeOnChannel=False,
@@ -392,12 +512,16 @@ class IrcStatusFactory(ThrottledClientFactory):
         super().__init__(lostDelay=lostDelay, failedDelay=failedDelay)
         self.nickname = nickname
         self.password = password
-        self.join_channels = join_channels
+        # (channel, password) pairs, parsed once rather than on each sign on
+        self.join_channels = [
+            (c.get('channel'), c.get('password')) if isinstance(c, dict) else (c, None)
+            for c in join_channels]
         self.pm_to_nicks = pm_to_nicks
         self.tags = tags
         self.authz = authz
         self.parent = parent
-        self.notify_events = notify_events
+        # only the event names matter, whether given as a list, set or dict
+        self.notify_events = frozenset(notify_events)
         self.noticeOnChannel = noticeOnChannel
         self.useRevisions = useRevisions
         self.showBlameList = showBlameList
@@ -405,11 +529,14 @@ class IrcStatusFactory(ThrottledClientFactory):
 
     def __getstate__(self):
         d = self.__dict__.copy()
-        del d['p']
+        # the protocol is only set as an instance attribute once connected
+        d.pop('p', None)
         return d
 
     def shutdown(self):
         self.shuttingDown = True
+        if self._reconnectCall is not None and self._reconnectCall.active():
+            self._reconnectCall.cancel()
         if self.p:
             self.p.quit("buildmaster reconfigured: bot disconnecting")
 
@@ -429,6 +556,22 @@ class IrcStatusFactory(ThrottledClientFactory):
         self.p = p
         return p
 
+    def resetDelay(self):
+        self.lostAttempts = 0
+        self.failedAttempts = 0
+
+    def _scheduleReconnect(self, connector, delay, attempts):
+        # back off exponentially while the server is unreachable, with some
+        # jitter so that bots sharing an outage do not reconnect in lockstep.
+        # maxDelay only limits the growth: a longer configured delay is kept.
+        # Returns the updated number of attempts.
+        delay = max(delay, min(self.maxDelay, delay * 2 ** attempts))
+        self._reconnectCall = reactor.callLater(delay * (0.5 + random.random()),
+                                                connector.connect)
+        if delay < self.maxDelay:
+            attempts += 1
+        return attempts
+
     # TODO: I think a shutdown that occurs while the connection is being
     # established will make this explode
 
@@ -436,18 +579,19 @@ class IrcStatusFactory(ThrottledClientFactory):
         if self.shuttingDown:
             log.msg("not scheduling reconnection attempt")
             return
-        super().clientConnectionLost(connector, reason)
+        self.lostAttempts = self._scheduleReconnect(
+            connector, self.lostDelay, self.lostAttempts)
 
     def clientConnectionFailed(self, connector, reason):
         if self.shuttingDown:
             log.msg("not scheduling reconnection attempt")
             return
-        super().clientConnectionFailed(connector, reason)
+        self.failedAttempts = self._scheduleReconnect(
+            connector, self.failedDelay, self.failedAttempts)
 
 
 class IRC(service.BuildbotService):
     name = "IRC"
-    in_test_harness = False
     f = None
     compare_attrs = ("host", "port", "nick", "password", "authz",
                      "channels", "pm_to_nicks", "useSSL",
@@ -545,8 +689,8 @@ class IRC(service.BuildbotService):
                                   useColors=useColors)
 
         if useSSL:
-            cf = ssl.ClientContextFactory()
-            c = internet.SSLClient(self.host, self.port, self.f, cf)
+            c = internet.SSLClient(self.host, self.port, self.f,
+                                   _ssl_context_factory)
         else:
             c = internet.TCPClient(self.host, self.port, self.f)
 
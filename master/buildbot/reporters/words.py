@@ -1090,8 +1090,8 @@ class StatusBot(service.AsyncMultiService):
         name = "{},{}".format(parent, source)
         return name
 
-    def log(self, msg, source=None):
-        log.callWithContext({"system": self._get_log_system(source)}, log.msg, msg)
+    def log(self, *msg, source=None, **kwargs):
+        log.callWithContext({"system": self._get_log_system(source)}, log.msg, *msg, **kwargs)
 
     def log_err(self, error=None, why=None, source=None):
         log.callWithContext({"system": (self._get_log_system(source))}, log.err, error, why)
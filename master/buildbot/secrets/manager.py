@@ -40,6 +40,5 @@ class SecretManager(service.BuildbotServiceManager):
         """
         for provider in self.services:
             value = yield provider.get(secret)
-            source_name = provider.__class__.__name__
             if value is not None:
-                return SecretDetails(source_name, secret, value)
+                return SecretDetails(provider.__class__.__name__, secret, value)
@@ -22,6 +22,8 @@ class SecretDetails:
     - value: secret value
     """
 
+    __slots__ = ['_source', '_key', '_value']
+
     def __init__(self, source, key, value):
         self._source = source
         self._value = value
@@ -4,7 +4,6 @@ from twisted.trial import unittest
 
 from buildbot.secrets.manager import SecretManager
 from buildbot.secrets.secret import SecretDetails
-from buildbot.test.fake import fakemaster
 from buildbot.test.fake.secrets import FakeSecretStorage
 from buildbot.test.util.misc import TestReactorMixin
 
@@ -13,9 +12,6 @@ class TestSecretsManager(TestReactorMixin, unittest.TestCase):
 
     def setUp(self):
         self.setUpTestReactor()
-        self.master = fakemaster.make_master(self)
-        self.master.config.secretsProviders = [FakeSecretStorage(secretdict={"foo": "bar",
-                                                                             "other": "value"})]
 
     @defer.inlineCallbacks
     def testGetManagerService(self):
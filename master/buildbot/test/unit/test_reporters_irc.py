@@ -14,12 +14,16 @@
 # Copyright Buildbot Team Members
 
 
+import random
 import sys
 
 import mock
 
 from twisted.application import internet
 from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.internet import task
+from twisted.test import proto_helpers
 from twisted.trial import unittest
 
 from buildbot.config import ConfigErrors
@@ -29,7 +33,9 @@ from buildbot.reporters import irc
 from buildbot.reporters import words
 from buildbot.test.unit.test_reporters_words import ContactMixin
 from buildbot.test.util import config
+from buildbot.test.util.logging import LoggingMixin
 from buildbot.util import service
+from buildbot.util import ssl
 
 
 class TestIrcContact(ContactMixin, unittest.TestCase):
@@ -192,16 +198,32 @@ class FakeContact(service.AsyncService):
         self.actions.append(data)
 
 
-class TestIrcStatusBot(unittest.TestCase):
+class TestIrcStatusBot(LoggingMixin, unittest.TestCase):
 
     def makeBot(self, *args, **kwargs):
         if not args:
-            args = ('nick', 'pass', ['#ch'], [], False)
+            args = ('nick', 'pass', [('#ch', None)], [], False)
         bot = irc.IrcStatusBot(*args, **kwargs)
         bot.parent = mock.Mock()
         bot.parent.master.db.state.getState = lambda *args, **kwargs: None
         return bot
 
+    def test_keepAlive(self):
+        clock = task.Clock()
+        self.patch(reactor, 'callLater', clock.callLater)
+        b = self.makeBot()
+        pings = []
+        b.ping = pings.append
+
+        b.makeConnection(proto_helpers.StringTransport())
+        clock.advance(59)
+        self.assertEqual(pings, [])
+        clock.pump([1, 60])
+        self.assertEqual(pings, ['nick', 'nick'])
+
+        b.connectionLost(None)
+        self.assertEqual(clock.getDelayedCalls(), [])
+
     def test_groupDescribe(self):
         b = self.makeBot()
         b.describe = lambda d, m: evts.append(('n', d, m))
@@ -219,7 +241,7 @@ class TestIrcStatusBot(unittest.TestCase):
         self.assertEqual(evts, [('n', '#chan', 'hi')])
 
     def test_groupChat_notice(self):
-        b = self.makeBot('nick', 'pass', ['#ch'], [], True)
+        b = self.makeBot('nick', 'pass', [('#ch', None)], [], True)
         b.notice = lambda d, m: evts.append(('n', d, m))
 
         evts = []
@@ -252,6 +274,14 @@ class TestIrcStatusBot(unittest.TestCase):
 
         self.assertIdentical(c1, c1b)
 
+    def test_getContact_rfc1459_casemapping(self):
+        b = self.makeBot()
+
+        c1 = b.getContact(user='Phoen[ix]', channel='#Chan^')
+        c1b = b.getContact(user='phoen{ix}', channel='#chan~')
+
+        self.assertIdentical(c1, c1b)
+
     def test_getContact_invalid(self):
         b = self.makeBot()
         b.authz = {'': None}
@@ -282,7 +312,7 @@ class TestIrcStatusBot(unittest.TestCase):
         self.assertEqual(c.messages, ['hello'])
 
     def test_privmsg_user_uppercase(self):
-        b = self.makeBot('NICK', 'pass', ['#ch'], [], False)
+        b = self.makeBot('NICK', 'pass', [('#ch', None)], [], False)
         b.contactClass = FakeContact
         b.privmsg('jimmy!~foo@bar', 'NICK', 'hello')
 
@@ -305,6 +335,36 @@ class TestIrcStatusBot(unittest.TestCase):
         c = b.getContact('jimmy', '#ch')
         self.assertEqual(c.messages, [' hello'])
 
+    def test_privmsg_channel_related_after_nickChanged(self):
+        b = self.makeBot()
+        b.contactClass = FakeContact
+        b.nickChanged('newnick')
+        b.privmsg('jimmy!~foo@bar', '#ch', 'nick: hello')
+        b.privmsg('jimmy!~foo@bar', '#ch', 'newnick, hi')
+
+        c = b.getContact('jimmy', '#ch')
+        self.assertEqual(c.messages, [' hi'])
+
+    def test_privmsg_channel_related_after_signedOn(self):
+        b = self.makeBot('nick', None, [('#ch', None)], [], False)
+        b.contactClass = FakeContact
+        b.sendLine = lambda line: None
+        # the server accepted an altered nickname
+        b.nickname = 'nick_'
+        b.signedOn()
+        b.privmsg('jimmy!~foo@bar', '#ch', 'nick_: hello')
+
+        c = b.getContact('jimmy', '#ch')
+        self.assertEqual(c.messages, [' hello'])
+
+    def test_nick_of_cache_bounded(self):
+        b = self.makeBot()
+        b.nick_cache_size = 2
+        self.assertEqual(b._nick_of('jimmy!~foo@bar'), 'jimmy')
+        self.assertEqual(b._nick_of('bobby!~foo@baz'), 'bobby')
+        self.assertEqual(b._nick_of('alice'), 'alice')
+        self.assertEqual(list(b._nick_cache), ['bobby!~foo@baz', 'alice'])
+
     def test_action_unrelated(self):
         b = self.makeBot()
         b.contactClass = FakeContact
@@ -330,32 +390,99 @@ class TestIrcStatusBot(unittest.TestCase):
         c = b.getContact('jimmy', '#ch')
         self.assertEqual(c.actions, ['waves at nick'])
 
-    def test_signedOn(self):
-        b = self.makeBot('nick', 'pass',
-                         ['#ch1', dict(channel='#ch2', password='sekrits')],
+    def makeSignedOnBot(self, password='pass'):
+        self.clock = task.Clock()
+        self.patch(reactor, 'callLater', self.clock.callLater)
+        b = self.makeBot('nick', password,
+                         [('#ch1', None), ('#ch2', 'sekrits')],
                          ['jimmy', 'bobby'], False)
-        evts = []
+        self.evts = []
 
         def msg(d, m):
-            evts.append(('m', d, m))
+            self.evts.append(('m', d, m))
         b.msg = msg
 
         def join(channel, key):
-            evts.append(('k', channel, key))
+            self.evts.append(('k', channel, key))
         b.join = join
+
+        def sendLine(line):
+            self.evts.append(('l', line))
+        b.sendLine = sendLine
         b.contactClass = FakeContact
 
         b.signedOn()
+        return b
 
-        self.assertEqual(sorted(evts), [
-            ('k', '#ch1', None),
-            ('k', '#ch2', 'sekrits'),
-            ('m', 'Nickserv', 'IDENTIFY pass'),
-        ])
+    def test_signedOn(self):
+        b = self.makeSignedOnBot()
+
+        # channels are not joined until NickServ had a chance to identify us
+        self.assertEqual(self.evts, [('m', 'Nickserv', 'IDENTIFY pass')])
         self.assertEqual(sorted(b.contacts.keys()),
                          # channels don't get added until joined() is called
                          sorted([('jimmy', 'jimmy'), ('bobby', 'bobby')]))
 
+        self.clock.advance(b.identify_timeout)
+        self.assertEqual(self.evts[-1], ('l', 'JOIN #ch2,#ch1 sekrits'))
+
+    def test_signedOn_loggedin(self):
+        b = self.makeSignedOnBot()
+        b.irc_900('server', ['nick', 'nick!~nick@host', 'nick', 'You are now logged in as nick'])
+
+        self.assertEqual(self.evts[-1], ('l', 'JOIN #ch2,#ch1 sekrits'))
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+        # a late confirmation does not join the channels again
+        b.irc_900('server', ['nick', 'nick!~nick@host', 'nick', 'You are now logged in as nick'])
+        self.clock.advance(b.identify_timeout)
+        self.assertEqual(len(self.evts), 2)
+
+    def test_signedOn_nickserv_notice(self):
+        b = self.makeSignedOnBot()
+        b.noticed('jimmy!~foo@bar', 'nick', 'hi')
+        self.assertEqual(len(self.evts), 1)
+
+        # NickServ confirms IDENTIFY, the server tells whether we are in
+        b.noticed('NickServ!NickServ@services.', 'nick', 'You are now identified for nick.')
+        self.assertEqual(self.evts[-1], ('l', 'WHOIS nick'))
+
+        b.irc_330('server', ['nick', 'someone', 'someone', 'is logged in as'])
+        self.assertNotIn(('l', 'JOIN #ch2,#ch1 sekrits'), self.evts)
+
+        b.irc_330('server', ['nick', 'NICK', 'nick', 'is logged in as'])
+        self.assertEqual(self.evts[-1], ('l', 'JOIN #ch2,#ch1 sekrits'))
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+        # later notices and WHOIS replies do not join the channels again
+        b.noticed('NickServ!NickServ@services.', 'nick', 'You are already identified.')
+        b.irc_330('server', ['nick', 'nick', 'nick', 'is logged in as'])
+        self.assertEqual(len(self.evts), 3)
+
+    def test_signedOn_no_password(self):
+        self.makeSignedOnBot(password=None)
+
+        self.assertEqual(self.evts, [('l', 'JOIN #ch2,#ch1 sekrits')])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_joinChannels(self):
+        b = self.makeBot('nick', None,
+                         [('ch1', None), ('#ch2', 'k2'), ('#ch,3', None),
+                          ('&ch4', None), ('#ch5', 'k5')],
+                         [], False)
+        b.max_join_length = 20
+        evts = []
+        b.sendLine = evts.append
+        b.join = lambda channel, key: evts.append((channel, key))
+
+        b._joinChannels()
+
+        self.assertEqual(evts, [
+            'JOIN #ch2,#ch5 k2,k5',
+            ('#ch,3', None),
+            'JOIN #ch1,&ch4',
+        ])
+
     def test_joined(self):
         b = self.makeBot()
         b.joined('#ch1')
@@ -363,6 +490,12 @@ class TestIrcStatusBot(unittest.TestCase):
         self.assertEqual(sorted(b.channels.keys()),
                          sorted(['#ch1', '#ch2']))
 
+    def test_joined_case_insensitive(self):
+        b = self.makeBot()
+        b.joined('#Ch[1]')
+        self.assertIdentical(b.getContact(user='u', channel='#ch{1}').channel,
+                             b.channels['#ch{1}'])
+
     def test_userLeft_or_userKicked(self):
         b = self.makeBot()
         b.getContact(channel='c', user='u')
@@ -381,9 +514,12 @@ class TestIrcStatusBot(unittest.TestCase):
 
     def test_other(self):
         # these methods just log, but let's get them covered anyway
+        self.setUpLogging()
         b = self.makeBot()
         b.left('#ch1')
         b.kickedFrom('#ch1', 'dustin', 'go away!')
+        self.assertLogged('^Left #ch1$')
+        self.assertLogged('^I have been kicked from #ch1 by dustin: go away!$')
 
     def test_format_build_status(self):
         b = self.makeBot()
@@ -445,6 +581,84 @@ class TestIrcStatusFactory(unittest.TestCase):
         f.shutdown()
         self.assertTrue(f.shuttingDown)
 
+    def test_getstate(self):
+        f = self.makeFactory()
+        self.assertNotIn('p', f.__getstate__())
+        f.p = mock.Mock()
+        state = f.__getstate__()
+        self.assertNotIn('p', state)
+        self.assertEqual(state['nickname'], 'nick')
+
+    def test_join_channels(self):
+        f = self.makeFactory('nick', 'pass',
+                             ['#ch1', dict(channel='#ch2', password='sekrits')],
+                             [], [], {}, {})
+        self.assertEqual(f.join_channels,
+                         [('#ch1', None), ('#ch2', 'sekrits')])
+
+    def setUpReconnect(self, **kwargs):
+        self.clock = task.Clock()
+        self.patch(reactor, 'callLater', self.clock.callLater)
+        self.patch(random, 'random', lambda: 0.5)
+        self.connector = mock.Mock()
+        return self.makeFactory(**kwargs)
+
+    def reconnectDelay(self, method):
+        method(self.connector, None)
+        call, = self.clock.getDelayedCalls()
+        delay = call.getTime() - self.clock.seconds()
+        self.clock.advance(delay)
+        return delay
+
+    def test_reconnect_backoff(self):
+        f = self.setUpReconnect(lostDelay=2, failedDelay=50)
+
+        self.assertEqual([self.reconnectDelay(f.clientConnectionFailed)
+                          for _ in range(4)],
+                         [50, 100, 200, 300])
+        self.assertEqual([self.reconnectDelay(f.clientConnectionLost)
+                          for _ in range(2)],
+                         [2, 4])
+        self.assertEqual(self.connector.connect.call_count, 6)
+
+        f.resetDelay()
+        self.assertEqual(self.reconnectDelay(f.clientConnectionFailed), 50)
+        self.assertEqual(self.reconnectDelay(f.clientConnectionLost), 2)
+
+    def test_reconnect_backoff_long_delay(self):
+        # configured delays above maxDelay are used as is, and not doubled
+        f = self.setUpReconnect(lostDelay=900, failedDelay=600)
+
+        self.assertEqual([self.reconnectDelay(f.clientConnectionFailed)
+                          for _ in range(3)],
+                         [600, 600, 600])
+        self.assertEqual([self.reconnectDelay(f.clientConnectionLost)
+                          for _ in range(3)],
+                         [900, 900, 900])
+        self.assertEqual((f.failedAttempts, f.lostAttempts), (0, 0))
+
+    def test_reconnect_failed_after_lost(self):
+        # losing the connection does not lengthen the delay of a following
+        # failed attempt
+        f = self.setUpReconnect(lostDelay=2, failedDelay=50)
+        self.assertEqual(self.reconnectDelay(f.clientConnectionLost), 2)
+        self.assertEqual(self.reconnectDelay(f.clientConnectionFailed), 50)
+
+    def test_reconnect_shuttingDown(self):
+        f = self.setUpReconnect()
+        f.shutdown()
+        f.clientConnectionLost(mock.Mock(), None)
+        f.clientConnectionFailed(mock.Mock(), None)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_shutdown_cancels_reconnect(self):
+        f = self.setUpReconnect()
+        f.clientConnectionFailed(self.connector, None)
+        f.shutdown()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.clock.advance(f.maxDelay * 2)
+        self.assertFalse(self.connector.connect.called)
+
 
 class TestIRC(config.ConfigErrorsMixin, unittest.TestCase):
 
@@ -507,12 +721,34 @@ class TestIRC(config.ConfigErrorsMixin, unittest.TestCase):
         p = factory.buildProtocol('address')
         self.assertIdentical(p, proto_obj)
         factory.protocol.assert_called_with(
-            'nick', 'pass', ['channels'], ['pm', 'to', 'nicks'], True,
-            {}, ['tags'], {'successToFailure': 1},
+            'nick', 'pass', [('channels', None)], ['pm', 'to', 'nicks'], True,
+            {}, ['tags'], frozenset(['successToFailure']),
             useColors=False,
             useRevisions=True,
             showBlameList=False)
 
+    @ssl.skipUnless
+    @defer.inlineCallbacks
+    def test_constr_ssl(self):
+        clients = []
+
+        def SSLClient(host, port, factory, contextFactory):
+            client = mock.Mock(name='ssl-client')
+            client.contextFactory = contextFactory
+            clients.append(client)
+            return client
+        self.patch(internet, 'SSLClient', SSLClient)
+
+        for host in ('foo', 'bar'):
+            ircStatus = self.makeIRC(host=host, useSSL=True)
+            yield ircStatus.startService()
+            clients[-1].setServiceParent.assert_called_with(ircStatus)
+
+        self.assertIsInstance(clients[0].contextFactory,
+                              ssl.ClientContextFactory)
+        self.assertIdentical(clients[0].contextFactory,
+                             clients[1].contextFactory)
+
     def test_service(self):
         irc = self.makeIRC()
         # just put it through its paces